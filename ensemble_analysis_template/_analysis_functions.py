@@ -3,16 +3,29 @@
 # ==============================================================================
 
 import argparse
+import contextlib
+import cProfile
 import dask
+import io
 import logging
+import marshal
 import os
 import numpy  as np
+import pstats
+import re
+import shutil
 import socket
+import threading
 import time
+import traceback
 import datetime
+import functools
+import json
+import math
 import xarray as xr 
 
-from dask.distributed import Client
+from dask.distributed import Client, as_completed, get_worker
+from dask.utils import key_split
 from dask_jobqueue import PBSCluster
 
 # ==============================================================================
@@ -28,6 +41,13 @@ def parse_command_line_arguments():
     parser.add_argument('--ensemble_name',type=str)
     parser.add_argument('--job_scheduler',type=str)
     parser.add_argument('--parallel',type=str,default="TRUE")
+    parser.add_argument('--plan',type=str,default="FALSE")
+    parser.add_argument('--precision',type=str,default="float32")
+    parser.add_argument('--profile',type=str,default="FALSE")
+    parser.add_argument('--profile_member',type=str,default="FALSE")
+    parser.add_argument('--progress_interval',type=int,default=60)
+    parser.add_argument('--resubmits',type=int,default=1)
+    parser.add_argument('--retries',type=int,default=2)
     parser.add_argument('--save_path',type=str)
     parser.add_argument('--save_name',type=str)
     parser.add_argument('--testing_mode',type=str,default="FALSE")
@@ -65,157 +85,1616 @@ def get_ensemble_data_path(ensemble_name):
     return ensemble_paths[ensemble_name]
 
 
+# ==============================================================================
+# FUNCTION: Get ensemble filename pattern
+#
+# Registry of regular expressions to parse the timeseries filenames of each
+# ensemble. Each pattern must provide the named groups:
+#     case       - the case name shared by all files of a single simulation
+#     forcing    - the forcing of the simulation
+#     member     - the ensemble member id
+#     component  - the model component
+#     variable   - the variable in the file
+#     date_range - the dates covered by the file
+# Cases with the same (forcing, member) are split parts of the same ensemble
+# member (e.g., historical and SSP) and are combined. Ensembles without an
+# entry here use the default pattern for CESM timeseries filenames
+# ==============================================================================
+
+def get_ensemble_filename_pattern(ensemble_name):
+
+    # e.g., b.e21.BHISTcmip6.f09_g17.LE2-1001.001.cam.h0.FLNT.185001-185912.nc
+    cesm_pattern = (
+        r"^(?P<compset>[^.]+\.[^.]+\.[^.]+)\.(?P<grid>[^.]+)\."
+        r"(?P<case>(?P<forcing>[^.]+)\.(?P<member>\d+))\."
+        r"(?P<component>[^.]+)\.(?P<stream>[^.]+)\.(?P<variable>[^.]+)\."
+        r"(?P<date_range>\d+-\d+)\.nc$"
+    )
+
+    ensemble_patterns = {
+        # e.g., b.e21.BHISTcmip6.f09_g17.CESM2-SF-AAER.001.cam.h0.FLNT.185001-201412.nc
+        #       b.e21.BSSP370cmip6.f09_g17.CESM2-SF-AAER-SSP370.001.cam.h0.FLNT.201501-205012.nc
+        "CESM2-SF":(
+            r"^(?P<compset>[^.]+\.[^.]+\.[^.]+)\.(?P<grid>[^.]+)\."
+            r"(?P<case>CESM2-SF-(?P<forcing>[A-Za-z]+)(?:-[^.]+)?\.(?P<member>\d+))\."
+            r"(?P<component>[^.]+)\.(?P<stream>[^.]+)\.(?P<variable>[^.]+)\."
+            r"(?P<date_range>\d+-\d+)\.nc$"
+        ),
+    }
+
+    return re.compile(ensemble_patterns.get(ensemble_name, cesm_pattern))
+
+# ==============================================================================
+# FUNCTION: Parse ensemble filename
+#
+# Returns a dict of the named groups of the pattern, or None (with a debug
+# message) for files that do not match
+# ==============================================================================
+
+def parse_ensemble_filename(filename,pattern):
+
+    match = pattern.match(filename)
+
+    if match is None:
+        logging.debug(f"Skipping file that does not match the ensemble filename pattern: {filename}")
+        return None
+
+    return match.groupdict()
+
 # ==============================================================================
 # FUNCTION: Read Casenames from Text File
 # ==============================================================================
 
-def read_casenames(casenames_file):
-    
-    logging.info("Reading in Case Names")
-    
-    casenames = []
-    with open(casenames_file,mode='r') as file:
-        for line in file.readlines():
-            casenames.append(line[:-1])
-            
-    return casenames
+def read_casenames(casenames_file):
+    
+    logging.info("Reading in Case Names")
+    
+    casenames = []
+    with open(casenames_file,mode='r') as file:
+        for line in file.readlines():
+            casenames.append(line[:-1])
+            
+    return casenames
+
+# ==============================================================================
+# FUNCTION: Generate filenames for each ensemble member
+# ==============================================================================
+
+def generate_ensemble_filenames(netcdf_variables,casenames,path,ensemble_name,delimeter="&&"):
+    
+    logging.info("Generating lists of files for each ensemble member")
+    
+    pattern = get_ensemble_filename_pattern(ensemble_name)
+    
+    # Empty dict to hold the files for each case name found on disk
+    files_by_case = {}
+
+    # Iterate over desired variables: this is because data is stored in 
+    # individual timeseries files for each variable
+    for var in netcdf_variables:
+        
+        # Temporary file directory for a given variable. Note that the file directory
+        # holds files for every ensemble member
+        file_dir_tmp = path + var + "/"
+
+        # Parse each filename exactly once and file it under its case name
+        for file in os.listdir(file_dir_tmp):
+            
+            file_info = parse_ensemble_filename(file,pattern)
+            
+            if file_info is None:
+                continue
+            
+            files_by_case.setdefault(file_info["case"],[]).append(file_dir_tmp + file)
+
+    # Empty dict to hold all files for all ensemble members    
+    case_files = {} 
+
+    # Generate a list of filenames for each ensemble member
+    for CASENAME in casenames:
+        
+        # -----------------------------------------------------------------
+        # Treatment for same-case, different-name (e.g., a single run with 
+        # historical forcing and then a SSP forcing, where the historical / 
+        # ssp data have different case names joined by the delimeter)
+        # -----------------------------------------------------------------            
+        CASEFILES_LIST = []
+        
+        for CASE in CASENAME.split(delimeter):
+            CASEFILES_LIST = CASEFILES_LIST + files_by_case.get(CASE,[])
+            
+        if CASEFILES_LIST == []:
+            logging.warning(f"No files found for Case: {CASENAME}")
+            
+        logging.debug(f"Found {len(CASEFILES_LIST)} files for Case: {CASENAME}")
+            
+        # Store the list of files for a specific ensemble member in the dict
+        case_files[CASENAME] = np.sort(CASEFILES_LIST)
+            
+    return case_files
+
+# ==============================================================================
+# FUNCTION: Get cluster resources
+#
+# Resources requested for each job of the dask cluster. These are also used by
+# the planner (--plan) as the baseline for its recommendations
+# ==============================================================================
+
+def get_cluster_resources():
+
+    cluster_resources = {
+        "memory_gb":128,         # Amount of memory per job
+        "processes":12,          # How many processes (dask workers) per job
+        "walltime":"02:00:00",   # Amount of wall time
+        "n_jobs":10,             # Number of jobs passed to cluster.scale()
+    }
+
+    return cluster_resources
+
+# ==============================================================================
+# FUNCTION: Setup the dask cluster
+# ==============================================================================
+
+def setup_cluster(user,job_scheduler="PBS"):
+    
+    cluster_resources = get_cluster_resources()
+    
+    if job_scheduler == "PBS":
+        
+        logging.info("Setting up a dask PBSCluster")
+    
+        # Setup your PBSCluster - make sure that it uses the casper queue
+        cluster = PBSCluster(
+                cores=1, # The number of cores you want
+                memory=f"{cluster_resources['memory_gb']}GB", # Amount of memory
+                processes=cluster_resources['processes'], # How many processes
+                queue='casper', # The type of queue to utilize (/glade/u/apps/dav/opt/usr/bin/execcasper)
+                local_directory='$TMPDIR', # Use your local directory
+                resource_spec=f"select=1:ncpus=6:mem={cluster_resources['memory_gb']}GB", # Specify resources
+                project='PROJECT', # Input your project ID here
+                walltime=cluster_resources['walltime'], # Amount of wall time
+                interface='ib0', # Interface to use
+            ) 
+        
+    # elif job_scheduler == "SLURM":
+        
+        # logging.info("Setting up a dask SLURMCluster)
+        # use dask-jobqueue.SLURMCluster to set up a cluster       
+        
+    else:
+        
+        cluster = "FAILED"
+        client  = "FAILED"
+        
+        job_scheduler_not_recognized_message = f'''
+=======================================================================================================================
+!!!UNABLE TO SETUP DASK CLUSTER!!!
+=======================================================================================================================
+THE JOB_SCHEDULER SUPPLIED BY THE USER: 
+        {job_scheduler}
+        
+IS NOT CURRENTLY SUPPORTED BY THIS APPLICATION.
+THIS CAN BE REMIDIED BY ADDING AN OPTION TO 
+        setup_cluster() IN THE SCRIPT _analysis_functions.py
+        
+EXITING
+        '''
+        
+        logging.error(job_scheduler_not_recognized_message)
+        
+        return cluster, client 
+        
+    cluster.scale(cluster_resources['n_jobs'])
+
+    client = Client(cluster)
+
+    # This is just to forward the host for ssh tunnelling so the dask dashboard
+    # can be viewed remotely.
+    host = client.run_on_scheduler(socket.gethostname)
+        
+    dask_logging_text = f'''    
+=======================================================================================================================
+DASK DIAGNOSTICS
+=======================================================================================================================
+To view the dask diagnostic dashboard for this job, follow this URL for a local or login-node job:
+        {client.dashboard_link}
+        
+If this is a remote PBS job on a HPC, need to first use SSH tunnelling. Login to cheyenne with the following command:
+        ssh -N -L 8888:{host}:8888  -L 8787:{host}:8787 {user}@casper.ucar.edu
+Then use this url:
+        http://localhost:8787/status
+        
+        '''
+
+    logging.info(dask_logging_text)
+
+    return cluster, client
+
+# ==============================================================================
+# FUNCTION: Get the precision policy
+#
+# Combine the run level precision (--precision) with the per-variable overrides
+# and the accumulation precision from custom_precision_policy()
+# ==============================================================================
+
+def get_precision_policy(precision):
+
+    supported_precisions = ["float32","float64"]
+
+    if precision not in supported_precisions:
+
+        precision_not_supported_message = f'''
+=======================================================================================================================
+!!!UNABLE TO INTERPRET PRECISION!!!
+=======================================================================================================================
+THE PRECISION SUPPLIED BY THE USER: 
+        {precision}
+        
+IS NOT SUPPORTED. PRECISION MUST BE ONE OF:
+        {supported_precisions}
+        
+EXITING
+        '''
+
+        logging.error(precision_not_supported_message)
+
+        return None
+
+    precision_policy = {"default":precision, **custom_precision_policy()}
+
+    logging.info(f"Precision policy: {precision_policy}")
+
+    return precision_policy
+
+# ==============================================================================
+# FUNCTION: Get the dtype of a variable under the precision policy
+#
+# Only floating point variables are affected by the precision policy
+# ==============================================================================
+
+def get_policy_dtype(var,dtype,precision_policy):
+
+    if precision_policy is None or not np.issubdtype(dtype, np.floating):
+        return np.dtype(dtype)
+
+    return np.dtype(precision_policy["variables"].get(var, precision_policy["default"]))
+
+# ==============================================================================
+# FUNCTION: Apply the precision policy
+#
+# Cast the floating point data variables of a dataset to the precision given by
+# the policy. Coordinates (e.g., time) keep their original precision
+# ==============================================================================
+
+def apply_precision_policy(dset,precision_policy):
+
+    if precision_policy is None:
+        return dset
+
+    for var in dset.data_vars:
+
+        policy_dtype = get_policy_dtype(var, dset[var].dtype, precision_policy)
+
+        if dset[var].dtype != policy_dtype:
+            dset[var] = dset[var].astype(policy_dtype)
+
+    return dset
+
+# ==============================================================================
+# FUNCTION: Reduce with the accumulation precision
+#
+# Perform an xarray reduction (e.g., "mean", "sum", "std") in the accumulation
+# precision of the policy and cast the result back to the input precision, e.g.
+#     precision_reduce(dset_ens.FLNT, "mean", dim="time")
+# ==============================================================================
+
+def precision_reduce(da,reduction,accumulate=None,**kwargs):
+
+    if accumulate is None:
+        accumulate = custom_precision_policy()["accumulate"]
+
+    if accumulate is None or not np.issubdtype(da.dtype, np.floating):
+        return getattr(da, reduction)(**kwargs)
+
+    result = getattr(da.astype(accumulate), reduction)(**kwargs)
+
+    return result.astype(da.dtype)
+
+# ==============================================================================
+# FUNCTION: Load shared inputs
+#
+# Static fields (e.g., area weights, land fraction or masks) are identical for
+# every ensemble member, so they are read once from the files of the first
+# ensemble member rather than from the files of every member
+# ==============================================================================
+
+def load_shared_inputs(case_files,shared_variables):
+
+    shared_inputs = {}
+
+    if shared_variables == []:
+        return shared_inputs
+
+    logging.info(f"Loading shared inputs: {shared_variables}")
+
+    ens_member_files = next(iter(case_files.values()))
+
+    for var in shared_variables:
+
+        for file in ens_member_files:
+
+            with xr.open_dataset(file) as dset:
+
+                if var in dset.variables:
+
+                    shared_inputs[var] = dset[var].load()
+
+                    logging.debug(f"Loaded shared input {var} from {file}")
+
+                    break
+
+    missing_variables = [x for x in shared_variables if x not in shared_inputs]
+
+    if missing_variables != []:
+
+        shared_inputs_not_found_message = f'''
+=======================================================================================================================
+!!!UNABLE TO LOAD SHARED INPUTS!!!
+=======================================================================================================================
+THE FOLLOWING SHARED VARIABLES WERE NOT FOUND IN THE FILES OF THE FIRST ENSEMBLE MEMBER:
+        {missing_variables}
+
+CHECK custom_shared_variable_list() IN THE SCRIPT _analysis_functions.py
+
+EXITING
+        '''
+
+        logging.error(shared_inputs_not_found_message)
+
+        return None
+
+    return shared_inputs
+
+# ==============================================================================
+# FUNCTION: Get the size of the input files for each ensemble member
+# ==============================================================================
+
+def get_member_bytes(case_files):
+
+    member_bytes = {
+        case: sum(os.path.getsize(file) for file in files)
+        for case, files in case_files.items()
+    }
+
+    return member_bytes
+
+# ==============================================================================
+# CLASS: Progress reporter
+#
+# Periodically write the number of ensemble members done / in flight / pending,
+# the rate at which the input is analyzed (the on-disk size of the input files
+# of the completed members), members per minute and an ETA to the log file, so
+# that a run can be monitored from the log alone (e.g., with qpeek). After the
+# ensemble members are analyzed, the reporter keeps running through the later
+# phases (e.g., combining and saving the output) and reports the time spent in
+# each. A warning is written when the throughput drops, the queue stalls or
+# workers are lost. Rates and stall detection only count the time since the
+# first worker joined the cluster (call workers_joined in parallel), and a
+# stall is only reported once members have started to complete, when no member
+# has completed for much longer than the longest gap seen between completions
+# ==============================================================================
+
+class ProgressReporter:
+
+    def __init__(self,case_files,interval=60,client=None,slowdown_fraction=0.5,stall_intervals=5):
+
+        self.interval          = interval
+        self.client            = client
+        self.slowdown_fraction = slowdown_fraction
+        self.stall_intervals   = stall_intervals
+
+        # Size of the input files for each ensemble member
+        self.member_bytes = get_member_bytes(case_files)
+
+        self.ncases = len(case_files)
+
+        # ensemble member -> dask key (None in serial) of the running attempt
+        self.running  = {}
+        self.finished = []
+        self.failed   = []
+
+        self.lock       = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread     = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+
+        # Members are analyzed in the first phase, later phases are set with
+        # set_phase
+        self.phase            = "analysis"
+        self.phase_start_time = None
+        self.analysis_seconds = None
+
+        self.start_time     = None
+        self.last_report    = None
+        self.last_finished  = 0
+        self.max_workers    = 0
+
+        # Set when the first worker joins, no time in the PBS queue is counted
+        self.work_start_time = None
+
+        # Time of the last completion and the longest gap between completions
+        self.last_completion = None
+        self.longest_gap     = 0.0
+
+    def start(self):
+
+        logging.info(f"Reporting progress every {self.interval} seconds")
+
+        self.start_time       = time.monotonic()
+        self.phase_start_time = self.start_time
+        self.last_report      = self.start_time
+
+        # In serial there is nothing to wait for
+        if self.client is None:
+            self.work_start_time = self.start_time
+
+        self.thread.start()
+
+    def workers_joined(self):
+
+        with self.lock:
+            self.work_start_time = time.monotonic()
+
+    def stop(self):
+
+        self.stop_event.set()
+
+        if self.thread.is_alive():
+            self.thread.join()
+
+        self.set_phase("complete")
+
+    def set_phase(self,phase):
+
+        now = time.monotonic()
+
+        with self.lock:
+
+            # Rates are only meaningful over the time the members were analyzed
+            if self.phase == "analysis":
+                self.analysis_seconds = now - (self.work_start_time or self.start_time)
+
+            self.phase            = phase
+            self.phase_start_time = now
+
+        self.report()
+
+    def member_started(self,case_name,key=None):
+
+        with self.lock:
+            self.running[case_name] = key
+
+    def member_finished(self,case_name,failed=False):
+
+        now = time.monotonic()
+
+        with self.lock:
+            self.running.pop(case_name, None)
+
+            # The first gap runs from the first worker joining
+            previous = self.last_completion or self.work_start_time or self.start_time
+
+            self.longest_gap     = max(self.longest_gap, now - previous)
+            self.last_completion = now
+
+            if failed:
+                self.failed.append(case_name)
+            else:
+                self.finished.append(case_name)
+
+    def _run(self):
+
+        while not self.stop_event.wait(self.interval):
+
+            try:
+                self.report()
+
+            # Never let a reporting problem interrupt the analysis
+            except Exception:
+                logging.exception("Unable to report progress")
+
+    def _n_in_flight(self,running):
+
+        # In serial, the member being analyzed is the only one in flight
+        if self.client is None:
+            return len(running)
+
+        # In parallel, submitted members may still be waiting in the queue, so
+        # only count those that are processing on a worker
+        processing = set()
+        for keys in self.client.processing().values():
+            processing.update(keys)
+
+        return sum(1 for key in running.values() if key in processing)
+
+    def report(self):
+
+        with self.lock:
+            running  = dict(self.running)
+            nfinish  = len(self.finished)
+            nfail    = len(self.failed)
+            mb_done  = sum(self.member_bytes[x] for x in self.finished + self.failed) / 1e6
+            phase    = self.phase
+            phase_start_time = self.phase_start_time
+            analysis_seconds = self.analysis_seconds
+            work_start_time  = self.work_start_time
+            last_completion  = self.last_completion
+            longest_gap      = self.longest_gap
+
+        now       = time.monotonic()
+        elapsed   = now - self.start_time
+        ndone     = nfinish + nfail
+
+        if phase != "analysis":
+            self._report_phase(now, elapsed, ndone, nfail, mb_done, phase, phase_start_time, analysis_seconds)
+            return
+
+        # e.g., the PBS jobs of the cluster are still waiting in the queue
+        if work_start_time is None:
+
+            logging.info(
+                f"PROGRESS: waiting for workers to join the cluster | "
+                f"0/{self.ncases} done | elapsed {datetime.timedelta(seconds=round(elapsed))}"
+            )
+
+            self.last_report = now
+
+            return
+
+        nflight   = self._n_in_flight(running)
+        npending  = self.ncases - ndone - nflight
+
+        # Rates over the time workers have been available
+        work_elapsed = now - work_start_time
+
+        mb_per_s      = mb_done / work_elapsed if work_elapsed > 0 else 0.0
+        members_per_m = 60 * ndone / work_elapsed if work_elapsed > 0 else 0.0
+
+        if members_per_m > 0:
+            eta = datetime.timedelta(seconds=round(60 * (self.ncases - ndone) / members_per_m))
+        else:
+            eta = "unknown"
+
+        logging.info(
+            f"PROGRESS: {ndone}/{self.ncases} done ({nfail} failed), "
+            f"{nflight} in flight, {npending} pending | "
+            f"{mb_per_s:.1f} MB/s of input analyzed, {members_per_m:.2f} members/min | "
+            f"elapsed {datetime.timedelta(seconds=round(elapsed))}, ETA {eta}"
+        )
+
+        self._check_throughput(now, ndone, members_per_m, last_completion, longest_gap)
+
+        self.last_report   = now
+        self.last_finished = ndone
+
+    def _report_phase(self,now,elapsed,ndone,nfail,mb_done,phase,phase_start_time,analysis_seconds):
+
+        # No member is in flight after the analysis, so report the phase and
+        # the rate over the analysis rather than a rate that decays while the
+        # output is combined and saved
+        mb_per_s      = mb_done / analysis_seconds if analysis_seconds else 0.0
+        members_per_m = 60 * ndone / analysis_seconds if analysis_seconds else 0.0
+
+        phase_text = f"PROGRESS: {phase} for {datetime.timedelta(seconds=round(now - phase_start_time))}"
+
+        # The cluster is still busy with the tasks of the save
+        if self.client is not None and phase != "complete":
+            nprocessing = sum(len(keys) for keys in self.client.processing().values())
+            phase_text += f", {nprocessing} tasks processing"
+
+        logging.info(
+            f"{phase_text} | "
+            f"{ndone}/{self.ncases} analyzed ({nfail} failed) in "
+            f"{datetime.timedelta(seconds=round(analysis_seconds or 0))}, "
+            f"{mb_per_s:.1f} MB/s of input analyzed, {members_per_m:.2f} members/min | "
+            f"elapsed {datetime.timedelta(seconds=round(elapsed))}"
+        )
+
+        # Only a lost worker is worth a warning outside the analysis
+        self._check_workers()
+
+        self.last_report = now
+
+    def _check_throughput(self,now,ndone,members_per_m,last_completion,longest_gap):
+
+        if ndone == self.ncases:
+            return
+
+        # Throughput since the previous report compared to the overall average
+        window  = now - self.last_report
+        nwindow = ndone - self.last_finished
+
+        # Members longer than the report interval are normal, so a stall is
+        # only reported once members complete and none has completed for twice
+        # the longest gap seen between completions
+        stall_seconds = max(self.stall_intervals * self.interval, 2 * longest_gap)
+
+        if last_completion is not None and now - last_completion > stall_seconds:
+
+            logging.warning(
+                f"PROGRESS STALLED: no ensemble members completed in the last "
+                f"{datetime.timedelta(seconds=round(now - last_completion))} "
+                f"(longest gap between completions so far: {datetime.timedelta(seconds=round(longest_gap))})"
+            )
+
+        elif ndone > 0 and window > 0 and nwindow > 0:
+
+            window_per_m = 60 * nwindow / window
+
+            if window_per_m < self.slowdown_fraction * members_per_m:
+
+                logging.warning(
+                    f"THROUGHPUT DROPPED: {window_per_m:.2f} members/min over the last "
+                    f"{datetime.timedelta(seconds=round(window))} vs. {members_per_m:.2f} members/min overall"
+                )
+
+        self._check_workers()
+
+    def _check_workers(self):
+
+        # Warn when workers have been lost from the cluster
+        if self.client is not None:
+
+            nworkers = len(self.client.scheduler_info()["workers"])
+
+            if nworkers < self.max_workers:
+                logging.warning(f"WORKERS LOST: {nworkers} workers connected (maximum seen: {self.max_workers})")
+
+            self.max_workers = max(self.max_workers, nworkers)
+
+# ==============================================================================
+# FUNCTION: Prune variables
+#
+# Used to preprocess each file at open time. CESM timeseries files carry many
+# ancillary variables (e.g., date_written, time_written, hyam, hybm, time_bnds,
+# nbdate) which would otherwise be combined across files and carried through
+# the task graph of every ensemble member. Only the requested variables and
+# their coordinates are kept
+# ==============================================================================
+
+def prune_variables(dset,keep_variables):
+
+    return dset[[x for x in keep_variables if x in dset.variables and x not in dset.coords]]
+
+# ==============================================================================
+# FUNCTION: Analyze a single ensemble member
+#
+# Each ensemble member is opened and analyzed as an independent unit of work so
+# that a corrupt file or a killed worker only affects that one member. The
+# output is written to `member_file` here, so that all of the reading and
+# computing for the member happens (and fails) inside this task rather than
+# later when the output is saved, and the output of the whole ensemble is never
+# held in memory. The path of the member file is returned. Leave member_file
+# as None to only build the lazy output
+# ==============================================================================
+
+def analyze_ensemble_member(ens_member_files, case_name, shared_inputs=None, precision_policy=None, keep_variables=None, member_file=None):
+
+    try:
+
+        # read the data, pruning each file to the requested variables before
+        # the files are combined
+        if keep_variables is None:
+            preprocess = None
+        else:
+            preprocess = functools.partial(prune_variables, keep_variables=keep_variables)
+
+        dset_ens = xr.open_mfdataset(ens_member_files, combine='by_coords', preprocess=preprocess)
+        dset_ens = apply_precision_policy(dset_ens, precision_policy)
+
+        output = custom_anaylsis_function(dset_ens, case_name, shared_inputs or {})
+
+        # Undo any promotion to float64 in the analysis
+        output = apply_precision_policy(output, precision_policy)
+
+        if member_file is None:
+            return output
+
+        # Write in the in-memory precision rather than the precision carried
+        # over in the encoding of the original files
+        for var in output.data_vars:
+            if np.issubdtype(output[var].dtype, np.floating):
+                output[var].encoding['dtype'] = output[var].dtype
+
+        # On a dask worker the member is already the unit of parallelism, so
+        # compute it in this task rather than sending the graph back to the
+        # scheduler
+        try:
+            get_worker()
+            write_config = dask.config.set(scheduler="synchronous")
+        except ValueError:
+            write_config = contextlib.nullcontext() # serial computation uses the current scheduler
+
+        # Write to a temporary file first so that a killed task does not leave
+        # a partial member file behind
+        with write_config:
+            output.to_netcdf(member_file + ".tmp")
+
+        os.replace(member_file + ".tmp", member_file)
+
+        dset_ens.close()
+
+        return member_file
+
+    except Exception as error:
+
+        # Record where the failure happened so that the member can be
+        # resubmitted to a different worker
+        try:
+            worker = get_worker().address
+        except ValueError:
+            worker = None # not running on a dask worker (serial computation)
+
+        # The original error and its traceback are chained to this one
+        member_error = RuntimeError(f"Analysis failed for ensemble member {case_name} on worker {worker}")
+        member_error.worker = worker
+
+        raise member_error from error
+
+# ==============================================================================
+# FUNCTION: Order ensemble members by cost
+#
+# Estimate the cost of each ensemble member from the size of its input files
+# (e.g., combined CESM2-SF cases have twice the files of xAER cases) and order
+# the members from largest to smallest, so that the largest members start
+# first rather than being left to run alone at the end
+# ==============================================================================
+
+def order_ensemble_members_by_cost(case_files,casenames):
+
+    member_bytes = get_member_bytes({x: case_files[x] for x in casenames})
+
+    ordered_casenames = sorted(casenames, key=lambda x: -member_bytes[x])
+
+    logging.info(
+        f"Ordered ensemble members by input size: largest {member_bytes[ordered_casenames[0]]/1e9:.2f} GB "
+        f"({ordered_casenames[0]}), smallest {member_bytes[ordered_casenames[-1]]/1e9:.2f} GB "
+        f"({ordered_casenames[-1]})"
+    )
+
+    return ordered_casenames
+
+# ==============================================================================
+# FUNCTION: Log the tail time
+#
+# The tail is the time from the moment the first worker runs out of work (when
+# fewer ensemble members remain than there are worker threads) until the last
+# member completes, i.e., the time the cluster spends waiting on stragglers.
+# Each member is loaded inside its task, so the completion times measure the
+# reading and computing of the member
+# ==============================================================================
+
+def log_tail_time(start_time,completion_times,n_workers):
+
+    if completion_times == []:
+        return
+
+    completion_times = sorted(completion_times)
+
+    makespan = completion_times[-1] - start_time
+
+    # Completion that leaves fewer remaining members than workers
+    first_idle_index = len(completion_times) - max(n_workers, 1)
+
+    if first_idle_index < 0:
+        first_idle_time = start_time
+    else:
+        first_idle_time = completion_times[first_idle_index]
+
+    tail_time = completion_times[-1] - first_idle_time
+
+    logging.info(
+        f"Makespan of the ensemble members: {datetime.timedelta(seconds=round(makespan))}. "
+        f"Tail time (first idle worker to last member completing): {datetime.timedelta(seconds=round(tail_time))} "
+        f"({100*tail_time/max(makespan,1e-9):.1f}% of the makespan)"
+    )
+
+# ==============================================================================
+# FUNCTION: Compute ensemble members in parallel
+#
+# Submit every ensemble member to the cluster as its own task, largest first
+# using dask task priorities. Dask retries a failed task up to `retries` times,
+# after which the member is resubmitted to a different worker up to `resubmits`
+# times before it is recorded as failed. Each task writes the output of its
+# member to a file in `member_path` and only the path is returned
+# ==============================================================================
+
+def compute_ensemble_members_parallel(client,case_files,casenames,member_path,shared_inputs=None,precision_policy=None,keep_variables=None,retries=2,resubmits=1,progress=None):
+
+    logging.info(f'Submitting {len(casenames)} ensemble members to the cluster')
+
+    # Successful output and the traceback of failed members
+    analysis_output = {}
+    failed_members  = {}
+
+    # Map each (possibly resubmitted) future to its ensemble member
+    futures     = {}
+    n_resubmits = {}
+
+    # Higher priority tasks are run first by dask
+    ordered_casenames = order_ensemble_members_by_cost(case_files,casenames)
+
+    priorities = {x: len(ordered_casenames) - i for i, x in enumerate(ordered_casenames)}
+
+    completion_times = []
+
+    for ENS_MEMBER in ordered_casenames:
+
+        future = client.submit(
+            analyze_ensemble_member,
+            case_files[ENS_MEMBER],
+            ENS_MEMBER,
+            shared_inputs,
+            precision_policy,
+            keep_variables,
+            member_path + ENS_MEMBER + ".nc",
+            retries=retries,
+            priority=priorities[ENS_MEMBER],
+            pure=False,
+        )
+
+        futures[future]         = ENS_MEMBER
+        n_resubmits[ENS_MEMBER] = 0
+
+        if progress is not None:
+            progress.member_started(ENS_MEMBER, key=future.key)
+
+    # Time the members from the first worker joining, not from the submission
+    # of the PBS jobs, so that time in the job queue is not counted
+    client.wait_for_workers(1)
+
+    if progress is not None:
+        progress.workers_joined()
+
+    start_time = time.monotonic()
+
+    completed_futures = as_completed(list(futures))
+
+    for future in completed_futures:
+
+        ENS_MEMBER = futures.pop(future)
+
+        if future.status == "finished":
+
+            # Before the result is gathered, which the client does one member
+            # at a time
+            completion_times.append(time.monotonic())
+
+            analysis_output[ENS_MEMBER] = future.result()
+
+            logging.debug(f'Analysis complete for ensemble member: {ENS_MEMBER}')
+
+            if progress is not None:
+                progress.member_finished(ENS_MEMBER)
+
+            continue
+
+        if future.status == "cancelled":
+            error           = None
+            error_traceback = f"Task for ensemble member {ENS_MEMBER} was cancelled"
+        else:
+            error           = future.exception()
+            error_traceback = "".join(
+                traceback.format_exception(type(error), error, future.traceback())
+            )
+
+        future.release()
+
+        if n_resubmits[ENS_MEMBER] < resubmits:
+
+            n_resubmits[ENS_MEMBER] += 1
+
+            # Prefer any worker other than the one the member failed on
+            failed_worker = getattr(error, "worker", None)
+            other_workers = [
+                worker for worker in client.scheduler_info()["workers"]
+                if worker != failed_worker
+            ]
+
+            logging.warning(
+                f"Ensemble member {ENS_MEMBER} failed after {retries} retries. "
+                f"Resubmitting ({n_resubmits[ENS_MEMBER]} of {resubmits})"
+            )
+            logging.debug(error_traceback)
+
+            new_future = client.submit(
+                analyze_ensemble_member,
+                case_files[ENS_MEMBER],
+                ENS_MEMBER,
+                shared_inputs,
+                precision_policy,
+                keep_variables,
+                member_path + ENS_MEMBER + ".nc",
+                retries=retries,
+                priority=priorities[ENS_MEMBER],
+                pure=False,
+                workers=other_workers or None,
+                allow_other_workers=True,
+            )
+
+            futures[new_future] = ENS_MEMBER
+            completed_futures.add(new_future)
+
+            if progress is not None:
+                progress.member_started(ENS_MEMBER, key=new_future.key)
+
+        else:
+
+            logging.error(f"ANALYSIS FAILED FOR ENSEMBLE MEMBER {ENS_MEMBER}")
+            logging.error(error_traceback)
+
+            failed_members[ENS_MEMBER] = error_traceback
+
+            completion_times.append(time.monotonic())
+
+            if progress is not None:
+                progress.member_finished(ENS_MEMBER, failed=True)
+
+    # Each worker thread analyzes one member at a time
+    n_threads = sum(x["nthreads"] for x in client.scheduler_info()["workers"].values())
+
+    log_tail_time(start_time, completion_times, n_threads)
+
+    # Keep the successful output in the original casename order
+    analysis_output = {x: analysis_output[x] for x in casenames if x in analysis_output}
+
+    return analysis_output, failed_members
+
+# ==============================================================================
+# FUNCTION: Compute ensemble members in serial
+#
+# As in parallel, the output of each member is written to a file in
+# `member_path` and only the path is returned
+# ==============================================================================
+
+def compute_ensemble_members_serial(case_files,casenames,member_path,shared_inputs=None,precision_policy=None,keep_variables=None,retries=2,progress=None):
+
+    # Successful output and the traceback of failed members
+    analysis_output = {}
+    failed_members  = {}
+
+    for ENS_MEMBER in casenames:
+
+        if progress is not None:
+            progress.member_started(ENS_MEMBER)
+
+        for attempt in range(retries + 1):
+
+            try:
+
+                analysis_output[ENS_MEMBER] = analyze_ensemble_member(case_files[ENS_MEMBER], ENS_MEMBER, shared_inputs, precision_policy, keep_variables, member_path + ENS_MEMBER + ".nc")
+
+                failed_members.pop(ENS_MEMBER, None)
+
+                break
+
+            except Exception:
+
+                failed_members[ENS_MEMBER] = traceback.format_exc()
+
+                logging.warning(f"Ensemble member {ENS_MEMBER} failed on attempt {attempt + 1} of {retries + 1}")
+                logging.debug(failed_members[ENS_MEMBER])
+
+        if ENS_MEMBER in failed_members:
+
+            logging.error(f"ANALYSIS FAILED FOR ENSEMBLE MEMBER {ENS_MEMBER}")
+            logging.error(failed_members[ENS_MEMBER])
+
+        if progress is not None:
+            progress.member_finished(ENS_MEMBER, failed=ENS_MEMBER in failed_members)
+
+    return analysis_output, failed_members
+
+# ==============================================================================
+# FUNCTION: Log a summary of failed ensemble members
+# ==============================================================================
+
+def log_failed_members(failed_members,ncases):
+
+    if failed_members == {}:
+
+        logging.info(f"ALL {ncases} ENSEMBLE MEMBERS ANALYZED SUCCESSFULLY")
+
+        return
+
+    nerror   = len(failed_members)
+    nsuccess = ncases - nerror
+
+    failed_members_logging_text = f'''
+=======================================================================================================================
+!!!ANALYSIS FAILED FOR {nerror} OF {ncases} ENSEMBLE MEMBERS!!!
+=======================================================================================================================
+THE FOLLOWING ENSEMBLE MEMBERS COULD NOT BE ANALYZED AND ARE EXCLUDED FROM THE OUTPUT:
+{chr(10).join("    * " + x for x in failed_members)}
+
+SEE THE TRACEBACKS ABOVE FOR DETAILS. THE REMAINING {nsuccess} ENSEMBLE MEMBERS
+WILL STILL BE COMBINED AND SAVED.
+        '''
+
+    logging.error(failed_members_logging_text)
+
+# ==============================================================================
+# FUNCTION: Open the member files
+#
+# Open the output file written for each ensemble member lazily, keeping the
+# chunks of the file, so that the members can be combined and saved without
+# loading the output of the whole ensemble into memory
+# ==============================================================================
+
+def open_member_files(member_files):
+
+    logging.info(f"Opening the output of {len(member_files)} ensemble members")
+
+    analysis_output = {
+        ENS_MEMBER: xr.open_dataset(file, chunks={})
+        for ENS_MEMBER, file in member_files.items()
+    }
+
+    return analysis_output
+
+# ==============================================================================
+# FUNCTION: Remove the member files
+#
+# The member files are only needed until the output is saved. They are kept
+# if any ensemble member could not be saved, so that nothing is lost
+# ==============================================================================
+
+def remove_member_files(analysis_output,member_path):
+
+    for dset in analysis_output.values():
+        dset.close()
+
+    if os.path.exists(member_path):
+
+        logging.info(f"Removing the ensemble member files in {member_path}")
+
+        shutil.rmtree(member_path)
+
+# ==============================================================================
+# FUNCTION: Record run metrics
+#
+# Append the size and duration of this run to a metrics file in the save path,
+# which the planner (--plan) uses to project the runtime of future runs
+# ==============================================================================
+
+def record_run_metrics(save_path,save_name,ncases,input_bytes,output_bytes,analysis_seconds,n_workers,parallel,precision):
+
+    metrics_file = save_path + save_name + "_run_metrics.json"
+
+    # The metrics are a by-product of the run, so a problem here is logged and
+    # does not stop the analysis
+    try:
+
+        if not os.path.exists(save_path):
+            logging.info(f'Creating directory {save_path}')
+            os.makedirs(save_path)
+
+        run_metrics = []
+
+        if os.path.exists(metrics_file):
+            with open(metrics_file,mode='r') as file:
+                run_metrics = json.load(file)
+
+        run_metrics.append(
+            {
+                "date":str(datetime.datetime.now()),
+                "ncases":ncases,
+                "input_bytes":input_bytes,
+                "output_bytes":output_bytes,
+                "analysis_seconds":analysis_seconds,
+                "n_workers":n_workers,
+                "parallel":parallel,
+                "precision":precision,
+            }
+        )
+
+        # Write to a temporary file first so an interrupted write does not
+        # leave a partial metrics file behind
+        with open(metrics_file + ".tmp",mode='w') as file:
+            json.dump(run_metrics,file,indent=4)
+
+        os.replace(metrics_file + ".tmp", metrics_file)
+
+        logging.info(f"Run metrics saved to {metrics_file}")
+
+    except Exception:
+        logging.exception(f"UNABLE TO RECORD RUN METRICS IN {metrics_file}")
+
+# ==============================================================================
+# FUNCTION: Plan the ensemble analysis
+#
+# Estimate the I/O volume, memory and runtime of the analysis from the file
+# sizes and netcdf headers only (no data is loaded), and recommend chunking and
+# cluster resources before a job is submitted
+# ==============================================================================
+
+def plan_ensemble_analysis(case_files,netcdf_variables,save_path,save_name,parallel,shared_variables=None,precision_policy=None,keep_variables=None,target_chunk_mb=128):
+
+    logging.info("Planning ensemble analysis from file sizes and netcdf headers")
+
+    ncases            = len(case_files)
+    cluster_resources = get_cluster_resources()
+
+    # --------------------------------------------------------------------------
+    # Bytes to read from disk and uncompressed size of the requested variables
+    # --------------------------------------------------------------------------
+
+    member_bytes        = get_member_bytes(case_files)
+    member_memory_bytes = {}
+    bytes_per_time_step = {}
+    time_steps_per_file = {}
+
+    for ENS_MEMBER, ens_member_files in case_files.items():
+
+        member_memory_bytes[ENS_MEMBER] = 0
+
+        for file in ens_member_files:
+
+            # Only the header is read here, no data is loaded
+            with xr.open_dataset(file, decode_cf=False) as dset:
+
+                for var in netcdf_variables:
+
+                    if var not in dset.data_vars:
+                        continue
+
+                    # Size in memory after the precision policy is applied
+                    itemsize = get_policy_dtype(var, dset[var].dtype, precision_policy).itemsize
+
+                    member_memory_bytes[ENS_MEMBER] += dset[var].size * itemsize
+
+                    if "time" in dset[var].dims and dset[var].sizes["time"] > 0:
+                        bytes_per_time_step[var] = dset[var].size // dset[var].sizes["time"] * itemsize
+                        time_steps_per_file[var] = max(time_steps_per_file.get(var, 0), dset[var].sizes["time"])
+
+    total_bytes        = sum(member_bytes.values())
+    total_memory_bytes = sum(member_memory_bytes.values())
+    max_member_memory  = max(member_memory_bytes.values())
+
+    # --------------------------------------------------------------------------
+    # Shared inputs, opened lazily from the files of the first ensemble member
+    # so that their headers are checked and no data is loaded
+    # --------------------------------------------------------------------------
+
+    shared_inputs = {}
+
+    for var in shared_variables or []:
+
+        for file in next(iter(case_files.values())):
+
+            # Left open, the analysis function is evaluated lazily below
+            dset = xr.open_dataset(file, chunks={})
+
+            if var in dset.variables:
+                shared_inputs[var] = dset[var]
+                break
+
+            dset.close()
+
+    missing_shared_variables = [x for x in shared_variables or [] if x not in shared_inputs]
+
+    if missing_shared_variables != []:
+        shared_inputs_text = f"NOT FOUND IN THE FILES OF THE FIRST MEMBER: {missing_shared_variables} (CHECK custom_shared_variable_list())"
+    else:
+        shared_inputs_text = f"{list(shared_inputs)}"
+
+    # --------------------------------------------------------------------------
+    # Size of the analysis output, from a lazy evaluation of the largest member
+    # --------------------------------------------------------------------------
+
+    sample_member = max(member_bytes, key=member_bytes.get)
+
+    try:
+
+        output_bytes = analyze_ensemble_member(case_files[sample_member], sample_member, shared_inputs, precision_policy, keep_variables).nbytes
+
+    except Exception:
+
+        logging.exception(f"Unable to evaluate the analysis function lazily for {sample_member}")
+
+        output_bytes = 0
+
+    # --------------------------------------------------------------------------
+    # Recommended chunking and cluster size
+    # --------------------------------------------------------------------------
+
+    # The files of each member are opened as separate chunks, so a chunk is
+    # never longer than the time axis of a file
+    recommended_chunks = {
+        var: {"time":max(1, min(int(target_chunk_mb * 1e6 // nbytes), time_steps_per_file[var]))}
+        for var, nbytes in bytes_per_time_step.items()
+    }
+
+    # Leave headroom of twice the input + output of the largest member
+    worker_memory_bytes = 2 * (max_member_memory + output_bytes)
+
+    recommended_processes = int(cluster_resources["memory_gb"] * 1e9 // max(worker_memory_bytes, 1))
+    recommended_processes = max(1, min(recommended_processes, cluster_resources["processes"]))
+
+    # Enough jobs to analyze every ensemble member at once
+    recommended_n_jobs = math.ceil(ncases / recommended_processes)
+
+    # --------------------------------------------------------------------------
+    # Runtime projection from the metrics of earlier runs
+    # --------------------------------------------------------------------------
+
+    metrics_file = save_path + save_name + "_run_metrics.json"
+
+    if parallel == "TRUE":
+        n_workers = min(ncases, recommended_processes * cluster_resources["n_jobs"])
+    else:
+        n_workers = 1
+
+    runtime_text = f"NO METRICS FROM EARLIER RUNS FOUND IN {metrics_file}"
+
+    if os.path.exists(metrics_file):
+
+        try:
+            with open(metrics_file,mode='r') as file:
+                run_metrics = [
+                    x for x in json.load(file)
+                    if x["parallel"] == parallel and x["analysis_seconds"] > 0 and x["n_workers"] > 0
+                ]
+
+        except (ValueError, KeyError, TypeError):
+            logging.exception(f"UNABLE TO READ METRICS FROM EARLIER RUNS IN {metrics_file}")
+            runtime_text = f"UNABLE TO READ METRICS FROM EARLIER RUNS IN {metrics_file}"
+            run_metrics  = []
+
+        if run_metrics != []:
+
+            # Average bytes read per second by a single worker
+            bytes_per_worker_second = np.mean(
+                [x["input_bytes"] / x["analysis_seconds"] / x["n_workers"] for x in run_metrics]
+            )
+
+            projected_seconds = total_bytes / (bytes_per_worker_second * n_workers)
+
+            # Add 50% headroom and round up to the next 15 minutes
+            walltime_seconds = 900 * math.ceil(1.5 * projected_seconds / 900)
+
+            runtime_text = (
+                f"PROJECTED ANALYSIS RUNTIME WITH {n_workers} WORKERS (FROM {len(run_metrics)} EARLIER RUNS): "
+                f"{datetime.timedelta(seconds=round(projected_seconds))}\n"
+                f"RECOMMENDED WALLTIME: {datetime.timedelta(seconds=walltime_seconds)} "
+                f"(CURRENT: {cluster_resources['walltime']})"
+            )
+
+    plan_logging_text = f'''
+=======================================================================================================================
+ENSEMBLE ANALYSIS PLAN
+=======================================================================================================================
+ENSEMBLE MEMBERS:                         {ncases}
+VARIABLES:                                {netcdf_variables}
+SHARED INPUTS:                            {shared_inputs_text}
+
+BYTES TO READ PER MEMBER (ON DISK):       {min(member_bytes.values())/1e9:.2f} - {max(member_bytes.values())/1e9:.2f} GB
+BYTES TO READ IN TOTAL (ON DISK):         {total_bytes/1e9:.2f} GB
+IN-MEMORY SIZE OF INPUT PER MEMBER:       {min(member_memory_bytes.values())/1e9:.2f} - {max_member_memory/1e9:.2f} GB
+IN-MEMORY SIZE OF INPUT IN TOTAL:         {total_memory_bytes/1e9:.2f} GB
+ANALYSIS OUTPUT PER MEMBER (ESTIMATED):   {output_bytes/1e9:.2f} GB (from {sample_member})
+ANALYSIS OUTPUT IN TOTAL (ESTIMATED):     {ncases*output_bytes/1e9:.2f} GB
+
+RECOMMENDED CHUNKS (~{target_chunk_mb} MB):          {recommended_chunks}
+RECOMMENDED MEMORY PER WORKER:            {worker_memory_bytes/1e9:.2f} GB
+RECOMMENDED PROCESSES PER JOB:            {recommended_processes} (CURRENT: {cluster_resources['processes']} x {cluster_resources['memory_gb']} GB)
+RECOMMENDED cluster.scale() JOBS:         {recommended_n_jobs} (CURRENT: {cluster_resources['n_jobs']})
+
+{runtime_text}
+
+CLUSTER RESOURCES CAN BE CHANGED IN get_cluster_resources() IN _analysis_functions.py
+        '''
+
+    logging.info(plan_logging_text)
+
+    return
+
+# ==============================================================================
+# FUNCTION: Profile a single ensemble member
+#
+# Run the analysis for one ensemble member under cProfile. The output is
+# computed with the synchronous scheduler in this thread, so that the profile
+# includes the xarray / dask operations rather than time spent waiting on the
+# distributed scheduler or a thread pool. The output is written to
+# `member_file` as in the analysis and removed afterwards. Returns the
+# marshalled stats, which is the same format written by
+# cProfile.Profile.dump_stats
+# ==============================================================================
+
+def profile_ensemble_member(ens_member_files, case_name, member_file, shared_inputs=None, precision_policy=None, keep_variables=None):
+
+    profiler = cProfile.Profile()
+
+    with dask.config.set(scheduler="synchronous"):
+
+        profiler.enable()
+
+        analyze_ensemble_member(ens_member_files, case_name, shared_inputs, precision_policy, keep_variables, member_file)
+
+        profiler.disable()
+
+    profiler.create_stats()
+
+    os.remove(member_file)
+
+    return marshal.dumps(profiler.stats)
 
 # ==============================================================================
-# FUNCTION: Generate filenames for each ensemble member
+# FUNCTION: Convert a dask profile to folded stacks
+#
+# The folded stack format ("frame;frame;frame count" per line) can be passed
+# directly to flame graph tools such as flamegraph.pl or speedscope
 # ==============================================================================
 
-def generate_ensemble_filenames(netcdf_variables,casenames,path,delimeter="&&"):
-    
-    logging.info("Generating lists of files for each ensemble member")
-    
-    # Empty dict to hold all files for all ensemble members    
-    case_files = {} 
+def dask_profile_to_folded_stacks(node,stack=(),folded_stacks=None):
 
-    # Only used for debugging
-    ncases = len(casenames)
-    i = 1
+    if folded_stacks is None:
+        folded_stacks = {}
 
-    # Generate a list of filenames for each ensemble member
-    for CASENAME in casenames:
-        
-        logging.debug(f"Generating Files for Case {i} of {ncases}: {CASENAME}")
+    if node.get("identifier") != "root":
 
-        # Initialize an empty list
-        CASEFILES_LIST = []    
-        
-        if delimeter in CASENAME:
-            CASENAME_LIST = CASENAME.split(delimeter)
-            
-        else:
-            CASENAME_LIST = [CASENAME]
+        description = node["description"]
 
-        # Iterate over desired variables: this is because data is stored in 
-        # individual timeseries files for each variable
-        for var in netcdf_variables:
-            
-            # Temporary file directory for a given variable. Note that the file directory
-            # holds files for every ensemble member
-            file_dir_tmp = path + var + "/"
+        frame = f"{description['name']} ({os.path.basename(description['filename'])}:{description['line_number']})"
 
-            # Get all files for a given variable
-            files_tmp = [file_dir_tmp + x for x in os.listdir(file_dir_tmp) if ".nc" in x]
-            
-            # -----------------------------------------------------------------
-            # START: Treatment for same-case, different-name 
-            # (e.g., a single run with historical forcing and then a SSP
-            # forcing, where the historical / ssp data have slightly different
-            # filenames that prevent simple string comprehension)
-            # -----------------------------------------------------------------            
-            files_tmp_case = []
-            
-            for CASE in CASENAME_LIST:
-                
-                # Filter to only include files for the specified ensemble member
-                files_tmp_case = files_tmp_case + [str(x) for x in files_tmp if CASE in x]
-                        
-            # Add files for the given variable to list of all files for the specified
-            # ensemble member
-            CASEFILES_LIST = np.sort(np.append(CASEFILES_LIST,files_tmp_case))
-            
-        # Store the list of files for a specific ensemble member in the dict
-        case_files[CASENAME] = CASEFILES_LIST
-        
-        i += 1
-            
-    return case_files
+        stack = stack + (frame,)
 
-def setup_cluster(user,job_scheduler="PBS"):
-    
-    if job_scheduler == "PBS":
-        
-        logging.info("Setting up a dask PBSCluster")
-    
-        # Setup your PBSCluster - make sure that it uses the casper queue
-        cluster = PBSCluster(
-                cores=1, # The number of cores you want
-                memory='128GB', # Amount of memory
-                processes=12, # How many processes
-                queue='casper', # The type of queue to utilize (/glade/u/apps/dav/opt/usr/bin/execcasper)
-                local_directory='$TMPDIR', # Use your local directory
-                resource_spec='select=1:ncpus=6:mem=128GB', # Specify resources
-                project='PROJECT', # Input your project ID here
-                walltime='02:00:00', # Amount of wall time
-                interface='ib0', # Interface to use
-            ) 
-        
-    # elif job_scheduler == "SLURM":
-        
-        # logging.info("Setting up a dask SLURMCluster)
-        # use dask-jobqueue.SLURMCluster to set up a cluster       
-        
-    else:
-        
-        cluster = "FAILED"
-        client  = "FAILED"
-        
-        job_scheduler_not_recognized_message = f'''
-=======================================================================================================================
-!!!UNABLE TO SETUP DASK CLUSTER!!!
-=======================================================================================================================
-THE JOB_SCHEDULER SUPPLIED BY THE USER: 
-        {job_scheduler}
-        
-IS NOT CURRENTLY SUPPORTED BY THIS APPLICATION.
-THIS CAN BE REMIDIED BY ADDING AN OPTION TO 
-        setup_cluster() IN THE SCRIPT _analysis_functions.py
-        
-EXITING
-        '''
-        
-        logging.error(job_scheduler_not_recognized_message)
-        
-        return cluster, client 
-        
-    cluster.scale(10)
+    # Samples in this frame that are not in any of its children
+    self_count = node["count"] - sum(child["count"] for child in node["children"].values())
 
-    client = Client(cluster)
+    if self_count > 0 and stack != ():
+        folded_stacks[";".join(stack)] = folded_stacks.get(";".join(stack), 0) + self_count
 
-    # This is just to forward the host for ssh tunnelling so the dask dashboard
-    # can be viewed remotely.
-    host = client.run_on_scheduler(socket.gethostname)
-        
-    dask_logging_text = f'''    
-=======================================================================================================================
-DASK DIAGNOSTICS
-=======================================================================================================================
-To view the dask diagnostic dashboard for this job, follow this URL for a local or login-node job:
-        {client.dashboard_link}
-        
-If this is a remote PBS job on a HPC, need to first use SSH tunnelling. Login to cheyenne with the following command:
-        ssh -N -L 8888:{host}:8888  -L 8787:{host}:8787 {user}@casper.ucar.edu
-Then use this url:
-        http://localhost:8787/status
-        
-        '''
+    for child in node["children"].values():
+        dask_profile_to_folded_stacks(child, stack, folded_stacks)
 
-    logging.info(dask_logging_text)           
-    
-    return cluster, client
+    return folded_stacks
+
+# ==============================================================================
+# FUNCTION: Save profiling results
+#
+# Write the dask statistical profile and task stream collected from the
+# workers (parallel only) and the cProfile stats of a sampled ensemble member
+# (if any) to the save path along with a top-N hot-function summary
+# ==============================================================================
+
+def save_profiling_results(dask_profile,task_stream,cprofile_stats,sample_member,save_path,save_name,top_n=25):
+
+    logging.info("Saving profiling results")
+
+    if not os.path.exists(save_path):
+        logging.info(f'Creating directory {save_path}')
+        os.makedirs(save_path)
+
+    profile_name = save_path + save_name + "_profile"
+
+    summary = []
+
+    # --------------------------------------------------------------------------
+    # Dask statistical profiler and task stream (parallel only)
+    # --------------------------------------------------------------------------
+
+    if dask_profile is not None:
+
+        folded_stacks = dask_profile_to_folded_stacks(dask_profile)
+
+        with open(profile_name + ".folded",mode='w') as file:
+            for stack, count in sorted(folded_stacks.items()):
+                file.writelines(f"{stack} {count}\n")
+
+        # Self samples of each function across all workers
+        function_counts = {}
+        for stack, count in folded_stacks.items():
+            frame = stack.split(";")[-1]
+            function_counts[frame] = function_counts.get(frame, 0) + count
+
+        total_count = max(sum(function_counts.values()), 1)
+
+        summary.append(f"TOP {top_n} FUNCTIONS ON THE DASK WORKERS (SELF SAMPLES)")
+        for frame, count in sorted(function_counts.items(), key=lambda x: -x[1])[:top_n]:
+            summary.append(f"    {100*count/total_count:6.2f}%  {count:8d}  {frame}")
+        summary.append("")
+
+    if task_stream is not None:
+
+        with open(profile_name + "_task_stream.json",mode='w') as file:
+            json.dump(task_stream,file,default=str)
+
+        # Compute time of each type of task
+        task_seconds = {}
+        for task in task_stream:
+            for startstop in task["startstops"]:
+                if startstop["action"] == "compute":
+                    prefix = key_split(task["key"])
+                    task_seconds[prefix] = task_seconds.get(prefix, 0) + startstop["stop"] - startstop["start"]
+
+        summary.append(f"TOP {top_n} TASK TYPES BY COMPUTE TIME (TASK STREAM)")
+        for prefix, seconds in sorted(task_seconds.items(), key=lambda x: -x[1])[:top_n]:
+            summary.append(f"    {seconds:10.2f} s  {prefix}")
+        summary.append("")
+
+    # --------------------------------------------------------------------------
+    # cProfile of the analysis for a single ensemble member
+    # --------------------------------------------------------------------------
+
+    if cprofile_stats is not None:
+
+        with open(profile_name + ".prof",mode='wb') as file:
+            file.write(cprofile_stats)
+
+        stats_text = io.StringIO()
+
+        stats = pstats.Stats(profile_name + ".prof", stream=stats_text)
+        stats.sort_stats("cumulative").print_stats(top_n)
+
+        summary.append(f"TOP {top_n} FUNCTIONS BY CUMULATIVE TIME (CPROFILE OF {sample_member})")
+        summary.append(stats_text.getvalue())
+
+    with open(profile_name + "_summary.txt",mode='w') as file:
+        file.writelines("\n".join(summary))
+
+    logging.info("\n".join(summary))
+
+    logging.info(f"Profiling results saved to {profile_name}*")
+
+# ==============================================================================
+# FUNCTION: Compute output statistics
+#
+# Summarize each ensemble member of the combined output for the output index,
+# from the data in memory before it is written rather than by reading the
+# written files back. The combined output is an outer join of the members, so
+# the time coverage of a member is taken from the times where it has data and
+# only the variables with data are listed. The min / max / mean of every
+# variable and member are computed together in a single pass
+# ==============================================================================
+
+def compute_output_statistics(dset_save):
+
+    logging.info("Computing output statistics for the output index")
+
+    numeric_vars = [x for x in dset_save.data_vars if np.issubdtype(dset_save[x].dtype, np.number)]
+
+    # Reduce over every dimension except the ensemble member
+    reductions = {}
+    for var in numeric_vars:
+
+        dims = [x for x in dset_save[var].dims if x != "ensemble_member"]
+
+        reductions[var] = {
+            "min":dset_save[var].min(dim=dims),
+            "max":dset_save[var].max(dim=dims),
+            "mean":precision_reduce(dset_save[var], "mean", dim=dims),
+        }
+
+    # Times at which each member has data in any variable
+    has_time = "time" in dset_save.coords and dset_save.time.size > 0
+
+    if has_time:
+
+        valid_time = xr.zeros_like(dset_save.time, dtype=bool)
+
+        for var in numeric_vars:
+            if "time" in dset_save[var].dims:
+                dims       = [x for x in dset_save[var].dims if x not in ("ensemble_member", "time")]
+                valid_time = valid_time | dset_save[var].notnull().any(dim=dims)
+
+        reductions["valid_time"] = valid_time
+
+    reductions, = dask.compute(reductions)
+
+    member_statistics = {}
+
+    for ENS_MEMBER in dset_save.ensemble_member.values:
+
+        member_index = {
+            "time_coverage":None,
+            "variables":[],
+            "statistics":{},
+        }
+
+        for var in dset_save.data_vars:
+
+            if var not in numeric_vars:
+                member_index["variables"].append(var)
+                continue
+
+            statistics = {
+                key: value.sel(ensemble_member=ENS_MEMBER).values.item()
+                for key, value in reductions[var].items()
+            }
+
+            # The member has no data for this variable
+            if np.isnan(statistics["min"]):
+                continue
+
+            member_index["variables"].append(var)
+            member_index["statistics"][var] = {key: float(value) for key, value in statistics.items()}
+
+        if has_time:
+
+            member_times = dset_save.time.values[
+                reductions["valid_time"].sel(ensemble_member=ENS_MEMBER).values
+            ]
+
+            if member_times.size > 0:
+                member_index["time_coverage"] = [str(member_times.min()), str(member_times.max())]
+
+        member_statistics[str(ENS_MEMBER)] = member_index
+
+    return member_statistics
+
+# ==============================================================================
+# FUNCTION: Write output index
+#
+# Write a compact sidecar index of the saved output, so that downstream users
+# can select ensemble members and see value ranges without opening and scanning
+# every data file. For each ensemble member the index records the output path,
+# time coverage, variables, per-variable min / max / mean (`member_statistics`,
+# from compute_output_statistics) and chunk layout. Only the headers of the
+# written files are read here. For outputs written as a directory of files, the
+# metadata (dimensions, coordinates and attributes) of every file is also
+# consolidated into a single file. `member_paths` maps each ensemble member to
+# the file that holds it
+# ==============================================================================
+
+def write_output_index(member_paths,member_statistics,index_file,consolidated_metadata_file=None):
+
+    logging.info("Writing output index")
+
+    output_index          = {}
+    consolidated_metadata = {}
+
+    # Several ensemble members may share the same file, so open each file once
+    paths = {}
+    for ENS_MEMBER, path in member_paths.items():
+        paths.setdefault(path, []).append(ENS_MEMBER)
+
+    for path, ens_members in paths.items():
+
+        with xr.open_dataset(path) as dset:
+
+            if consolidated_metadata_file is not None:
+                consolidated_metadata[os.path.basename(path)] = dset.to_dict(data=False)
+
+            # Chunk layout of the file as written
+            chunks = {}
+            for var in dset.data_vars:
+
+                chunksizes = dset[var].encoding.get("chunksizes")
+
+                chunks[var] = {
+                    "dims":list(dset[var].dims),
+                    "chunksizes":None if chunksizes is None else list(chunksizes),
+                }
+
+        for ENS_MEMBER in ens_members:
+
+            output_index[ENS_MEMBER] = {
+                "path":os.path.abspath(path),
+                **member_statistics[ENS_MEMBER],
+                "chunks":chunks,
+            }
+
+    with open(index_file,mode='w') as file:
+        json.dump(output_index,file,indent=4)
+
+    logging.info(f"Output index saved to {index_file}")
+
+    if consolidated_metadata_file is not None:
+
+        with open(consolidated_metadata_file,mode='w') as file:
+            json.dump(consolidated_metadata,file,indent=4,default=str)
+
+        logging.info(f"Consolidated metadata saved to {consolidated_metadata_file}")
 
 # ==============================================================================
 # ==============================================================================
@@ -247,13 +1726,87 @@ def custom_variable_list():
     
     return netcdf_variables
 
+# ==============================================================================
+# FUNCTION: custom coordinate list
+# 
+# Pass the list of additional variables to keep when the files are opened.
+# Every other variable that is not in custom_variable_list() is dropped from
+# each file before the files are combined. Dimension coordinates (e.g., time,
+# lat, lon) are always kept
+# ==============================================================================
+
+
+def custom_coordinate_list():
+    
+    logging.info("Getting list of coordinates for import")
+    
+    coordinate_variables = [
+        # "time_bnds",
+        # "hyam",
+        # "hybm",
+        # Add variables here
+    ]
+    
+    for var in coordinate_variables:
+        logging.debug(f" * {var}")
+    
+    return coordinate_variables
+
+# ==============================================================================
+# FUNCTION: custom shared variable list
+# 
+# Pass the list of static fields (e.g., area weights "gw" / "area", land
+# fraction or masks) that are loaded once and shared by every ensemble member.
+# In parallel, these are broadcast to every dask worker a single time instead
+# of being read and shipped with the task of each ensemble member
+# ==============================================================================
+
+
+def custom_shared_variable_list():
+    
+    logging.info("Getting list of shared variables for import")
+    
+    shared_variables = [
+        # "gw",
+        # Add variables here
+    ]
+    
+    for var in shared_variables:
+        logging.debug(f" * {var}")
+    
+    return shared_variables
+
+# ==============================================================================
+# FUNCTION: custom precision policy
+# 
+# Per-variable precision overrides of the run level precision (PRECISION in
+# submit.sh), and the precision used to accumulate reductions performed with
+# precision_reduce(). CESM timeseries are float32 on disk, so keeping float32
+# halves the memory and output size compared to float64
+# ==============================================================================
+
+
+def custom_precision_policy():
+    
+    precision_policy = {
+        "accumulate":"float64", # None to accumulate in the input precision
+        "variables":{
+            # "TS":"float64",
+            # Add per-variable overrides here
+        },
+    }
+    
+    return precision_policy
+
 # ==============================================================================
 # FUNCTION: custom analysis function
 # 
-# Perform the primary analysis for a single ensemble member
+# Perform the primary analysis for a single ensemble member. The static fields
+# from custom_shared_variable_list() are available in the dict shared_inputs,
+# e.g., shared_inputs["gw"]
 # ==============================================================================
 
-def custom_anaylsis_function(dset_ens, case_name):
+def custom_anaylsis_function(dset_ens, case_name, shared_inputs):
     logging.debug(f'Performing analysis for ensemble member: {case_name}')
     
     logging.debug(f'Calculating cloud radiative effect at TOA')
@@ -313,7 +1866,7 @@ def custom_combination_function(analysis_output_computed):
 #
 # I have included logic here to ensure that data is not lost after calculation
 # just because of an issue with writing all ensemble members to a single
-# netcdf file
+# netcdf file. Returns True if every ensemble member was saved
 # ==============================================================================
 
 
@@ -328,50 +1881,63 @@ def custom_save_function(dset_save,save_path,save_name,parallel,ensemble_name,da
     
     # String manipulations to generate appropriate path/filename
     save_str      = f"_{len(dset_save.ensemble_member)}_ens_members"
-    save_filename = f"{ENSEMBLE_NAME}_{save_name}"
+    save_filename = f"{ensemble_name}_{save_name}"
     SAVE_NAME     = save_path + save_filename + save_str + ".nc"
     
-    # serialization issue -> remove variables date_written, time_written
-    problem_vars = ["date_written","time_written"]
-        
-    for var in problem_vars:
-        
-        try:
-            dset_save = dset_save.drop_vars(var)
-            logging.debug(f"Removed {var} from dataset")
-        except ValueError:
-            logging.debug(f"{var} not found in dataset")
+    # variable "time_encoding" largely copied from the original netcdf files
+    # Not sure why I need to specify the netcdf ncoding, but adding this step
+    # supressed some warnings and it doesn't appear to break anything else.
+    # Note that xarray moves the time units into .encoding when decoding time
+    encoding = {}
     
-    try:
-        
-        logging.info("Attempting to write all ensemble members to the same file.")
+    if "time" in dset_save.variables:
         
-        # variable "time_encoding" largely copied from the original netcdf files
-        # Not sure why I need to specify the netcdf ncoding, but adding this step
-        # supressed some warnings and it doesn't appear to break anything else
         time_encoding = {
             'zlib': True, 
             'shuffle': True, 
             'complevel': 1, 
             'fletcher32': False, 
             'contiguous': False, 
-            'chunksizes': (512,), 
+            'chunksizes': (min(512, dset_save.time.size),), 
             'source': data_path, 
             'original_shape': (600,), 
             'dtype': np.dtype('float64'), 
-            'units': dset_save.time.units, 
-            'calendar': 'noleap'
         }
-
-        encoding = {'time':time_encoding}
+        
+        # An analysis that rebuilds the time axis (e.g., resample or groupby)
+        # drops the units and calendar, which xarray then chooses when writing
+        for key in ['units','calendar']:
+            if dset_save.time.encoding.get(key) is not None:
+                time_encoding[key] = dset_save.time.encoding[key]
+        
+        encoding['time'] = time_encoding
+    
+    # Write data variables in their in-memory precision rather than the
+    # precision carried over in the encoding of the original files. Only the
+    # dtype is overridden, so the compression and _FillValue are kept
+    for var in dset_save.data_vars:
+        if np.issubdtype(dset_save[var].dtype, np.floating):
+            dset_save[var].encoding['dtype'] = dset_save[var].dtype
+    
+    # Statistics for the sidecar index, computed before the write so that the
+    # written files do not need to be read back
+    try:
+        member_statistics = compute_output_statistics(dset_save)
+    except Exception:
+        logging.exception("UNABLE TO COMPUTE OUTPUT STATISTICS")
+        member_statistics = None
+    
+    try:
+        
+        logging.info("Attempting to write all ensemble members to the same file.")
         
         if parallel == "TRUE":
             
             logging.info("Writing files in parallel")
         
-            dset_save.to_netcdf(SAVE_NAME,encoding=encoding,compute=False)
+            delayed_write = dset_save.to_netcdf(SAVE_NAME,encoding=encoding,compute=False)
             
-            dset_save.compute()
+            delayed_write.compute()
             
         else:
             
@@ -379,7 +1945,22 @@ def custom_save_function(dset_save,save_path,save_name,parallel,ensemble_name,da
         
         logging.info(f'Data successfully saved to:\n    {SAVE_NAME}')  
         
-    except:
+        # Sidecar index of the ensemble members in the file
+        if member_statistics is not None:
+            try:
+                write_output_index(
+                    member_paths      = {str(x): SAVE_NAME for x in dset_save.ensemble_member.values},
+                    member_statistics = member_statistics,
+                    index_file        = save_path + save_filename + save_str + "_index.json",
+                )
+            except Exception:
+                logging.exception("UNABLE TO WRITE OUTPUT INDEX")
+        
+        return True
+        
+    except Exception:
+        
+        logging.exception("Error while writing all ensemble members to the same file")
         
         # Now that we are writing one file for each ensemble member,
         # create a new directory in the old one to hold this data
@@ -390,7 +1971,7 @@ def custom_save_function(dset_save,save_path,save_name,parallel,ensemble_name,da
             os.mkdir(new_save_path)        
         
         # Remove the file that the script unsuccessfully attempted to write
-        if not os.path.exists(SAVE_NAME):
+        if os.path.exists(SAVE_NAME):
             os.remove(SAVE_NAME)
         
         logging.warning("UNABLE TO WRITE ALL ENSEMBLE MEMBERS TO THE SAME FILE")
@@ -401,17 +1982,20 @@ def custom_save_function(dset_save,save_path,save_name,parallel,ensemble_name,da
         # keep track of any cases script is unable to save
         problem_cases = []
         
+        # keep track of the file for each case that is saved
+        saved_cases = {}
+        
         ncases   = len(dset_save.ensemble_member) 
         i = 1
         
         for ENS_NAME in dset_save.ensemble_member:
             
+            # String manipulations to generate appropriate path/filename for 
+            # each ensemble member
+            ENS_NAME_STR  = str(ENS_NAME.data)
+            NEW_SAVE_NAME = new_save_path + ENS_NAME_STR + save_filename + ".nc"
+            
             try:
-                
-                # String manipulations to generate appropriate path/filename for 
-                # each ensemble member
-                ENS_NAME_STR  = str(ENS_NAME.data)
-                NEW_SAVE_NAME = new_save_path + ENS_NAME_STR + save_filename + ".nc"
             
                 logging.info(f"Case {i} of {ncases}. Saving {ENS_NAME_STR + save_filename + '.nc'}")
                 i += 1
@@ -419,21 +2003,23 @@ def custom_save_function(dset_save,save_path,save_name,parallel,ensemble_name,da
                 # Save the data for the single ensemble member
                 
                 if parallel == "TRUE":
-                    dset_save.sel(ensemble_member=ENS_NAME).to_netcdf(NEW_SAVE_NAME,encoding=encoding,compute=False)
+                    delayed_write = dset_save.sel(ensemble_member=ENS_NAME).to_netcdf(NEW_SAVE_NAME,encoding=encoding,compute=False)
                     
-                    dset_save.compute()
+                    delayed_write.compute()
                     
                 else:
                     
                     dset_save.sel(ensemble_member=ENS_NAME).to_netcdf(NEW_SAVE_NAME,encoding=encoding,compute=True)
                 
-            except:
+                saved_cases[ENS_NAME_STR] = NEW_SAVE_NAME
+                
+            except Exception:
                 
                 # Remove the file that the script unsuccessfully attempted to write
-                if not os.path.exists(NEW_SAVE_NAME):
+                if os.path.exists(NEW_SAVE_NAME):
                     os.remove(NEW_SAVE_NAME)
                 
-                logging.error(f"UNABLE TO SAVE DATA FOR CASE {ENS_NAME_STR}")    
+                logging.exception(f"UNABLE TO SAVE DATA FOR CASE {ENS_NAME_STR}")    
                 
                 problem_cases.append(ENS_NAME_STR)
                 
@@ -451,5 +2037,17 @@ def custom_save_function(dset_save,save_path,save_name,parallel,ensemble_name,da
         else:
             logging.warning("ALL CASES SUCCESSFULLY SAVED TO INDIVIDUAL FILES")
             logging.info(f"Saved data located:\n    {new_save_path}")
+        
+        # Sidecar index and consolidated metadata for the directory of files
+        if saved_cases != {} and member_statistics is not None:
+            try:
+                write_output_index(
+                    member_paths               = saved_cases,
+                    member_statistics          = member_statistics,
+                    index_file                 = new_save_path + save_filename + "_index.json",
+                    consolidated_metadata_file = new_save_path + save_filename + "_metadata.json",
+                )
+            except Exception:
+                logging.exception("UNABLE TO WRITE OUTPUT INDEX")
             
-    return
+    return problem_cases == []
@@ -27,7 +27,7 @@ def main():
     # ==========================================================================
     #    * 1.A Parse command line argument
     #    * 1.B Initialize Logging
-    #    * 1.C Setup Parallel / Serial Analysis
+    #    * 1.C Setup Parallel / Serial Analysis (skipped when planning)
     #    * 1.D Read in list of case names from file
     # ==========================================================================
     
@@ -44,6 +44,13 @@ def main():
     ENSEMBLE_NAME  = args.ensemble_name.upper()
     JOB_SCHEDULER  = args.job_scheduler.upper()
     PARALLEL       = args.parallel.upper()
+    PLAN           = args.plan.upper()
+    PRECISION      = args.precision.lower()
+    PROFILE        = args.profile.upper()
+    PROFILE_MEMBER = args.profile_member.upper()
+    PROGRESS_INTERVAL = args.progress_interval
+    RESUBMITS      = args.resubmits
+    RETRIES        = args.retries
     SAVE_PATH      = args.save_path
     SAVE_NAME      = args.save_name
     TESTING_MODE   = args.testing_mode.upper()
@@ -66,20 +73,23 @@ def main():
     # --------------------------------------------------------------------------
     # 1.C Setup Parallel / Serial Analysis
     # --------------------------------------------------------------------------
-    if PARALLEL == "FALSE":
+    if PLAN == "TRUE":
+        
+        logging.info(f"Flag \"plan\" set to TRUE. Planning the analysis without loading data or starting a cluster")
+        
+        cluster, client = None, None
+    
+    elif PARALLEL == "FALSE":
         
         logging.info(f"Flag \"parallel\" set to FALSE. Computation Proceeding in Serial")
         
-        parallel_or_serial_open_function     = xr.open_mfdataset
-        parallel_or_serial_analysis_function = custom_anaylsis_function
+        # No dask cluster is used for serial computation
+        cluster, client = None, None
     
     elif PARALLEL == "TRUE":
         
         logging.info(f"Flag \"parallel\" set to TRUE.")
         
-        parallel_or_serial_open_function     = dask.delayed(xr.open_mfdataset)
-        parallel_or_serial_analysis_function = dask.delayed(custom_anaylsis_function)
-        
         logging.info(f'Initializing dask client')
         
         cluster, client = setup_cluster(user=USER,job_scheduler=JOB_SCHEDULER)
@@ -138,14 +148,16 @@ ANALYZING {n_ensembles_for_test} ENSEMBLE MEMBERS
     # Section 2
     # ==========================================================================
     #    * 2.A Generate list of filenames for each ensemble member
+    #       * PLAN: Report the planned resources and exit
     #    * 2.B Iterate over ensemble members
-    #        * 2.B.1 Prepare analysis
-    #        * 2.B.2 Collect results
-    #    * 2.C
-    #       * PARALLEL: Perform delayed computation
-    #       * SERIAL: No Action
+    #    * 2.C Analyze each ensemble member independently
+    #       * PARALLEL: Submit one task per member with retries / resubmission
+    #       * SERIAL: Analyze one member at a time with retries
     #    * 2.D Combine results
     #    * 2.E Save data to disk
+    #    * 2.F Record run metrics
+    #    * 2.G PROFILE: Save profiling results
+    #    * 2.H Remove the ensemble member files
     # ==========================================================================    
 
     # --------------------------------------------------------------------------
@@ -155,72 +167,144 @@ ANALYZING {n_ensembles_for_test} ENSEMBLE MEMBERS
     # Get list of variables to load
     NETCDF_VARIABLES = custom_variable_list()
     
+    # Variables kept when the files are opened, everything else is dropped
+    KEEP_VARIABLES = NETCDF_VARIABLES + custom_coordinate_list()
+    
+    # Precision of the data through open, analysis, combination and write
+    PRECISION_POLICY = get_precision_policy(PRECISION)
+    
+    if PRECISION_POLICY is None:
+        return
+    
     DATA_PATH = get_ensemble_data_path(ENSEMBLE_NAME) + DATA_FREQ + "/"
     
     CASE_FILES = generate_ensemble_filenames(
         netcdf_variables = NETCDF_VARIABLES,
         casenames        = CASENAMES,
-        path             = DATA_PATH
+        path             = DATA_PATH,
+        ensemble_name    = ENSEMBLE_NAME,
     )  
     
+    if PLAN == "TRUE":
+        
+        plan_ensemble_analysis(
+            case_files       = CASE_FILES,
+            netcdf_variables = NETCDF_VARIABLES,
+            save_path        = SAVE_PATH,
+            save_name        = SAVE_NAME,
+            parallel         = PARALLEL,
+            shared_variables = custom_shared_variable_list(),
+            precision_policy = PRECISION_POLICY,
+            keep_variables   = KEEP_VARIABLES,
+        )
+        
+        return
+    
+    # Load static fields shared by every ensemble member once
+    SHARED_INPUTS = load_shared_inputs(
+        case_files       = CASE_FILES,
+        shared_variables = custom_shared_variable_list(),
+    )
+    
+    if SHARED_INPUTS is None:
+        return
+    
     # --------------------------------------------------------------------------
     # 2.B Iterate over ensemble members
     # --------------------------------------------------------------------------  
     
     logging.info(f'Iterating over ensemble members')
     
-    # Empty dict to hold analysis output for every ensemble member
-    ANALYSIS_OUTPUT_LIST = {}
-    
-    for ENS_MEMBER in CASENAMES:
-        
-        # --------------------------------------------------------------------------
-        # 2.B.1 Prepare Parallel or Serial Analysis
-        # --------------------------------------------------------------------------          
-        
-        logging.debug(f'Prepare task graph for Case: {ENS_MEMBER}')
-        
-        # Get the files for the particular ensemble member
-        ens_member_files = CASE_FILES[ENS_MEMBER]
-        
-        # Need to specify as 9 or below to log all files
-        if int(VERBOSE) < 10:
-            for file in ens_member_files:
+    # Need to specify as 9 or below to log all files
+    if int(VERBOSE) < 10:
+        for ENS_MEMBER in CASENAMES:
+            for file in CASE_FILES[ENS_MEMBER]:
                 logging.debug(file)
         
-        # read the data - use dask delayed
-        dset_ens = parallel_or_serial_open_function(ens_member_files, combine='by_coords')
-        
-        # Create the task graph of the custom analysis function for lazy eval
-        analysis_output = parallel_or_serial_analysis_function(dset_ens,ENS_MEMBER)
-        
-        # --------------------------------------------------------------------------
-        # 2.B.2 Collect results (delayed objects)
-        # --------------------------------------------------------------------------  
-        
-        # Store the delayed objects in a dict for later computation
-        ANALYSIS_OUTPUT_LIST[ENS_MEMBER] = analysis_output
-        
-    logging.info('COMPLETED Iterating over ensemble members.')
+    # The output of each ensemble member is written to its own file here,
+    # rather than being held in memory until the save
+    MEMBER_PATH = SAVE_PATH + SAVE_NAME + "_members/"
+    
+    logging.info(f'Writing the output of each ensemble member to {MEMBER_PATH}')
+    
+    os.makedirs(MEMBER_PATH, exist_ok=True)
+    
+    # Periodically report progress to the log file
+    PROGRESS = ProgressReporter(
+        case_files = CASE_FILES,
+        interval   = PROGRESS_INTERVAL,
+        client     = client,
+    )
+    
+    PROGRESS.start()
+    
+    analysis_start_time = datetime.datetime.now()
+    
+    # Start of the window for the dask profiler and task stream, which covers
+    # both the analysis and the save
+    profile_start_time = time.time()
+    
+    if PROFILE == "TRUE" and PARALLEL == "TRUE":
         
+        # The first call registers the task stream plugin on the scheduler, so
+        # tasks are only recorded from this point on
+        client.get_task_stream()
+    
     # --------------------------------------------------------------------------
-    # 2.C.PARALLEL Perform delayed computation and collect results
+    # 2.C.PARALLEL Submit each ensemble member as an independent task
     # --------------------------------------------------------------------------
     
     if PARALLEL == "TRUE":
            
-        logging.info(f'Performing delayed parallel computation. Note, a long wait here may indicate the PBS job to initialize the cluster is waiting in the job queue.')
+        logging.info(f'Performing parallel computation. Note, a long wait here may indicate the PBS job to initialize the cluster is waiting in the job queue.')
+
+        # Send the shared inputs to every worker once. The futures are passed
+        # to each task as handles and resolved to the data on the worker
+        if SHARED_INPUTS != {}:
+            
+            logging.info(f'Broadcasting shared inputs to all workers')
+            
+            SHARED_INPUTS = client.scatter(SHARED_INPUTS, broadcast=True)
 
-        ANALYSIS_OUTPUT_COMPUTED_LIST = dask.compute([x for x in ANALYSIS_OUTPUT_LIST.values()])[0]
+        MEMBER_FILES, FAILED_MEMBERS = compute_ensemble_members_parallel(
+            client           = client,
+            case_files       = CASE_FILES,
+            casenames        = CASENAMES,
+            member_path      = MEMBER_PATH,
+            shared_inputs    = SHARED_INPUTS,
+            precision_policy = PRECISION_POLICY,
+            keep_variables   = KEEP_VARIABLES,
+            retries          = RETRIES,
+            resubmits        = RESUBMITS,
+            progress         = PROGRESS,
+        )
         
     # --------------------------------------------------------------------------
-    # 2.C.SERIAL Collect Results
+    # 2.C.SERIAL Analyze each ensemble member in turn
     # --------------------------------------------------------------------------        
         
     else:
         
-        # Take the values of the computation as a list
-        ANALYSIS_OUTPUT_COMPUTED_LIST = [x for x in ANALYSIS_OUTPUT_LIST.values()]
+        MEMBER_FILES, FAILED_MEMBERS = compute_ensemble_members_serial(
+            case_files       = CASE_FILES,
+            casenames        = CASENAMES,
+            member_path      = MEMBER_PATH,
+            shared_inputs    = SHARED_INPUTS,
+            precision_policy = PRECISION_POLICY,
+            keep_variables   = KEEP_VARIABLES,
+            retries          = RETRIES,
+            progress         = PROGRESS,
+        )
+        
+    # Keep reporting progress while the output is combined and saved
+    PROGRESS.set_phase("combining output")
+        
+    logging.info('COMPLETED Iterating over ensemble members.')
+    
+    log_failed_members(FAILED_MEMBERS,ncases)
+    
+    # The output of every member stays on disk until it is written
+    ANALYSIS_OUTPUT_COMPUTED = open_member_files(MEMBER_FILES)
     
     # --------------------------------------------------------------------------
     # 2.D Combine results
@@ -228,25 +312,103 @@ ANALYZING {n_ensembles_for_test} ENSEMBLE MEMBERS
     
     logging.info('Computations complete. Preparing to combine output for saving')
   
-    # Combine the casenames and computed output into a dictionary
-    
     logging.debug("="*120)
-    logging.debug(f"ANALYSIS_OUTPUT_COMPUTED_LIST")
-    for x in ANALYSIS_OUTPUT_COMPUTED_LIST:
+    logging.debug(f"ANALYSIS_OUTPUT_COMPUTED")
+    for x in ANALYSIS_OUTPUT_COMPUTED.values():
         logging.debug(x)
     logging.debug("="*120)
     
-    ANALYSIS_OUTPUT_COMPUTED = dict(zip(CASENAMES, ANALYSIS_OUTPUT_COMPUTED_LIST))
+    if ANALYSIS_OUTPUT_COMPUTED == {}:
+        
+        logging.error("NO ENSEMBLE MEMBERS WERE ANALYZED SUCCESSFULLY. NOTHING TO SAVE.")
+        
+        KEEP_MEMBER_FILES = False
+        
+    else:
     
-    logging.info(f'Combining output for saving')
+        logging.info(f'Combining output for saving')
+        
+        dset_save = custom_combination_function(ANALYSIS_OUTPUT_COMPUTED)
+        
+        # ----------------------------------------------------------------------
+        # 2.E Save data to disk
+        # ----------------------------------------------------------------------  
+
+        PROGRESS.set_phase("saving output")
+
+        # Keep the member files if any ensemble member could not be saved
+        KEEP_MEMBER_FILES = not custom_save_function(dset_save,SAVE_PATH,SAVE_NAME,PARALLEL,ENSEMBLE_NAME,DATA_PATH)
+    
+    PROGRESS.stop()
     
-    dset_save = custom_combination_function(ANALYSIS_OUTPUT_COMPUTED)
+    # End of the window for the dask profiler and task stream
+    profile_stop_time = time.time()
     
     # --------------------------------------------------------------------------
-    # 2.e Save data to disk
-    # --------------------------------------------------------------------------  
-
-    custom_save_function(dset_save,SAVE_PATH,SAVE_NAME,PARALLEL,ENSEMBLE_NAME,DATA_PATH)
+    # 2.F Record run metrics
+    # --------------------------------------------------------------------------
+    
+    # Record the size and duration of this run for the planner. The duration
+    # runs to the end of the save, which is part of the job's walltime
+    record_run_metrics(
+        save_path        = SAVE_PATH,
+        save_name        = SAVE_NAME,
+        ncases           = ncases,
+        input_bytes      = sum(PROGRESS.member_bytes.values()),
+        output_bytes     = sum(x.nbytes for x in ANALYSIS_OUTPUT_COMPUTED.values()),
+        analysis_seconds = (datetime.datetime.now() - analysis_start_time).total_seconds(),
+        n_workers        = len(client.scheduler_info()["workers"]) if PARALLEL == "TRUE" else 1,
+        parallel         = PARALLEL,
+        precision        = PRECISION,
+    )
+    
+    # --------------------------------------------------------------------------
+    # 2.G Save profiling results
+    # --------------------------------------------------------------------------
+    
+    if PROFILE == "TRUE":
+        
+        dask_profile, task_stream = None, None
+        
+        # Collected before any member is profiled again below. The workers keep
+        # their profile in cycles of about a second, so the stop time alone
+        # does not exclude work that follows it closely
+        if PARALLEL == "TRUE":
+            dask_profile = client.profile(start=profile_start_time, stop=profile_stop_time)
+            task_stream  = client.get_task_stream(start=profile_start_time, stop=profile_stop_time)
+        
+        # Profile the analysis for one successful ensemble member. This
+        # analyzes the member a second time, so it is optional
+        sample_member = next(iter(ANALYSIS_OUTPUT_COMPUTED), None)
+        
+        cprofile_stats = None
+        
+        if PROFILE_MEMBER == "TRUE" and sample_member is not None:
+            
+            logging.info(f'Profiling the analysis function for ensemble member: {sample_member}')
+            
+            if PARALLEL == "TRUE":
+                cprofile_stats = client.submit(profile_ensemble_member, CASE_FILES[sample_member], sample_member, MEMBER_PATH + "profile.nc", SHARED_INPUTS, PRECISION_POLICY, KEEP_VARIABLES, pure=False).result()
+            else:
+                cprofile_stats = profile_ensemble_member(CASE_FILES[sample_member], sample_member, MEMBER_PATH + "profile.nc", SHARED_INPUTS, PRECISION_POLICY, KEEP_VARIABLES)
+        
+        save_profiling_results(
+            dask_profile   = dask_profile,
+            task_stream    = task_stream,
+            cprofile_stats = cprofile_stats,
+            sample_member  = sample_member,
+            save_path      = SAVE_PATH,
+            save_name      = SAVE_NAME,
+        )
+    
+    # --------------------------------------------------------------------------
+    # 2.H Remove the ensemble member files
+    # --------------------------------------------------------------------------
+    
+    if KEEP_MEMBER_FILES:
+        logging.warning(f"NOT ALL ENSEMBLE MEMBERS WERE SAVED. KEEPING THE ENSEMBLE MEMBER FILES IN:\n    {MEMBER_PATH}")
+    else:
+        remove_member_files(ANALYSIS_OUTPUT_COMPUTED, MEMBER_PATH)
     
     end_time = datetime.datetime.now()
     
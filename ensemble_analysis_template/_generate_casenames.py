@@ -13,60 +13,30 @@ from _analysis_functions import *
 # Generate Case Names
 # ==============================================================================
 
-def generate_case_names(path):
+def generate_case_names(path,ENSEMBLE_NAME,delimiter="&&"):
 
-    # List of all files in path
-    files = np.sort([x for x in os.listdir(path) if ".nc" in x])
+    pattern = get_ensemble_filename_pattern(ENSEMBLE_NAME)
 
-    # Split the string on ".cam."
-    cases = []
+    # Group the case names of each ensemble member by (forcing, member). Split
+    # cases (e.g., historical and SSP) of the same ensemble member share a key
+    split_cases = {}
 
-    for file in files:
-        
-        # get the central string between "f09_g17" and ".cam."
-        file_tmp = file.split("f09_g17.")[1]
-        file_tmp = file_tmp.split(".cam.")[0]
-        
-        cases.append(file_tmp)
-            
-    cases = np.unique(cases)
-
-    return cases
-
-def combine_split_cases(cases,ENSEMBLE_NAME,delimiter="&&"):
-    
-    if ENSEMBLE_NAME == "CESM2-SF":
-    
-        combined_cases = []
-
-        # Check for each of AAER, BMB, EE, GHG. Don't need to do xAER
+    for file in os.listdir(path):
 
-        for forcing in ["AAER","BMB","EE","GHG"]:
+        # Parse each filename exactly once
+        file_info = parse_ensemble_filename(file,pattern)
 
-            cases_tmp = [case for case in cases if forcing in case]
+        if file_info is None:
+            continue
 
-            case_numbers = [case[-3:] for case in cases_tmp]
+        key = (file_info["forcing"], file_info["member"])
 
-            for case_number in case_numbers:
+        split_cases.setdefault(key, set()).add(file_info["case"])
 
-                # Select the cases with the same case id number
+    # Join split cases into a single case name
+    cases = [delimiter.join(sorted(x)) for x in split_cases.values()]
 
-                combined_cases_tmp = [case for case in cases_tmp if case_number in case]
-
-                combined_cases.append(delimiter.join(combined_cases_tmp))
-
-        # Lastly, add in the xAER cases
-        forcing = "xAER"
-        cases_tmp = [case for case in cases if forcing in case]
-
-        for case in cases_tmp:
-
-            combined_cases.append(case)
-            
-    else:
-        return np.unique(cases)
-            
-    return np.unique(combined_cases)
+    return np.unique(cases)
 
 
 # ==============================================================================
@@ -134,13 +104,18 @@ EXITING.
         return    
     
     # Use OLR as an exmaple variable to generate casenames
-    DATA_PATH = get_ensemble_data_path(ENSEMBLE_NAME) + DATA_FREQ + "/FLNT"
+    DATA_PATH = get_ensemble_data_path(ENSEMBLE_NAME) + DATA_FREQ + "/FLNT/"
     
-    # Generate case names
-    cases = generate_case_names(DATA_PATH,)
+    # Generate case names, combining split cases of the same ensemble member
+    cases = generate_case_names(DATA_PATH,ENSEMBLE_NAME)
     
-    # Function which is necessary for certain ensembles but not for others
-    cases = combine_split_cases(cases,ENSEMBLE_NAME)
+    if len(cases) == 0:
+        
+        logging.error(f"NO FILES IN {DATA_PATH} MATCH THE FILENAME PATTERN FOR {ENSEMBLE_NAME}")
+        logging.error(f"CHECK get_ensemble_filename_pattern() IN _analysis_functions.py")
+        logging.error(f"EXITING")
+        
+        return
 
     # --------------------------------------------------------------------------
     # Save case names to a text files
@@ -38,6 +38,13 @@ conda activate py_ucar
 # ENSEMBLE_NAME:   String identifier to help with functions. See _analysis_functions.py for a list of supported members
 # JOB_SCHEDULER:    Type of system for the dask cluster
 # PARALLEL:        (valid: "TRUE", "FALSE") Use Parallel or Serial computing 
+# PLAN:            (valid: "TRUE", "FALSE") If "TRUE", only estimate I/O volume, memory, runtime and cluster size (no data is loaded)
+# PRECISION:       (valid: "float32", "float64") Precision of floating point data through open, analysis, combination and write
+# PROFILE:         (valid: "TRUE", "FALSE") If "TRUE", save dask profiler / task stream data in SAVE_PATH
+# PROFILE_MEMBER:  (valid: "TRUE", "FALSE") If "TRUE" (with PROFILE), also save a cProfile of one member, which analyzes it a second time
+# PROGRESS_INTERVAL: Seconds between progress reports (done / in flight / pending, MB/s, ETA, then the combine and save) in the log file
+# RESUBMITS:       Number of times a failed ensemble member is resubmitted to a different worker (parallel only)
+# RETRIES:         Number of times a failed ensemble member is retried before it is resubmitted or recorded as failed
 # SAVE_PATH:       Location to store output files
 # SAVE_NAME:       String identifier for output files
 # TESTING_MODE:    (valid: "TRUE", "FALSE") If "TRUE", perform analysis on only two ensemble members
@@ -48,6 +55,13 @@ DATA_FREQ="month_1"
 ENSEMBLE_NAME="CESM2-LE"
 JOB_SCHEDULER="SLURM"
 PARALLEL="TRUE"
+PLAN="FALSE"
+PRECISION="float32"
+PROFILE="FALSE"
+PROFILE_MEMBER="FALSE"
+PROGRESS_INTERVAL="60"
+RESUBMITS="1"
+RETRIES="2"
 SAVE_PATH="/glade/work/$USER/data_misc/cesm2_lens/cloud_radiative_effect/"
 SAVE_NAME="cld-rad-effect-toa" 
 TESTING_MODE="TRUE"
@@ -59,7 +73,7 @@ VERBOSE="20"
 python3 _generate_casenames.py --casenames_file $CASENAMES_FILE --data_freq $DATA_FREQ --ensemble_name $ENSEMBLE_NAME
 
 # 2. PERFORM THE PRIMARY DATA ANALYSIS
-python3 _ensemble_analysis.py --casenames_file $CASENAMES_FILE --data_freq $DATA_FREQ --ensemble_name $ENSEMBLE_NAME --job_scheduler $JOB_SCHEDULER --parallel $PARALLEL --save_path $SAVE_PATH --save_name $SAVE_NAME --testing_mode $TESTING_MODE --user $USER --verbose $VERBOSE 
+python3 _ensemble_analysis.py --casenames_file $CASENAMES_FILE --data_freq $DATA_FREQ --ensemble_name $ENSEMBLE_NAME --job_scheduler $JOB_SCHEDULER --parallel $PARALLEL --plan $PLAN --precision $PRECISION --profile $PROFILE --profile_member $PROFILE_MEMBER --progress_interval $PROGRESS_INTERVAL --resubmits $RESUBMITS --retries $RETRIES --save_path $SAVE_PATH --save_name $SAVE_NAME --testing_mode $TESTING_MODE --user $USER --verbose $VERBOSE 
 
 echo "Finished ensemble analysis script"
 